@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks for pyscript_util
+Measures per-call overhead of the command execution paths
+
+Usage:
+    python benchmark.py engines [-n 200] [--ballast-mb 0]
+    python benchmark.py session [-n 10000]
+    python benchmark.py upward [-n 2000] [--depths 5,20,50]
+    python benchmark.py find [-n 5] [--packages 200]
+"""
+
+import os
+import sys
+import time
+import argparse
+import shutil
+import tempfile
+
+# Run against the working tree, not an installed copy
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import pyscript_util.pyscript_util as psu
+
+
+class silenced_stdout:
+    """Redirect fd 1 to /dev/null so child output does not skew the timings"""
+
+    def __enter__(self):
+        sys.stdout.flush()
+        self.saved = os.dup(1)
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 1)
+        os.close(devnull)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        sys.stdout.flush()
+        os.dup2(self.saved, 1)
+        os.close(self.saved)
+        return False
+
+
+def time_calls(label, func, iterations):
+    """Call func() iterations times with stdout silenced and print the per-call cost"""
+    with silenced_stdout():
+        start = time.perf_counter()
+        for _ in range(iterations):
+            func()
+        elapsed = time.perf_counter() - start
+    per_call_us = elapsed / iterations * 1e6
+    print(f"{label:<40} {iterations:>6} calls  {elapsed:8.3f}s  {per_call_us:10.1f} us/call")
+    return elapsed
+
+
+def bench_engines(args):
+    """Compare os.system against the spawn engine, with and without a shell"""
+    # Optional ballast to show how fork cost grows with process RSS
+    ballast = bytearray(args.ballast_mb * 1024 * 1024)
+    for offset in range(0, len(ballast), 4096):
+        ballast[offset] = 1
+    print(f"Process ballast: {args.ballast_mb} MB")
+
+    system_engine = psu.SystemEngine()
+    spawn_engine = psu.SpawnEngine()
+    time_calls("os.system (fork + /bin/sh)", lambda: system_engine.run("true"), args.iterations)
+    time_calls("spawn engine, direct exec", lambda: spawn_engine.run("true"), args.iterations)
+    time_calls("spawn engine, via /bin/sh", lambda: spawn_engine.run("true; true"), args.iterations)
+
+
+def bench_session(args):
+    """Compare one persistent ShellSession against a fresh os.system call per command"""
+    system_engine = psu.SystemEngine()
+    time_calls("os.system per command", lambda: system_engine.run("test -d /"), args.iterations)
+    with psu.ShellSession() as session:
+        session.run("true")  # exclude shell startup from the loop
+        time_calls("ShellSession (one bash process)", lambda: session.run("test -d /"), args.iterations)
+
+
+def naive_find_upwards(filename, start):
+    """The pre-scandir find_file_upwards walk: one os.path.exists per level, no logging"""
+    current_path = os.path.normpath(os.path.realpath(start))
+    while True:
+        file_path = os.path.join(current_path, filename)
+        if os.path.exists(file_path):
+            return file_path
+        parent_path = os.path.normpath(os.path.dirname(current_path))
+        if parent_path == current_path:
+            return None
+        current_path = parent_path
+
+
+def bench_upward(args):
+    """Compare upward searches at several depths: naive walk, scandir cold, cached warm"""
+    root = tempfile.mkdtemp(prefix="pyscript_util_bench_")
+    try:
+        for depth in (int(d) for d in args.depths.split(",")):
+            tree = os.path.join(root, f"depth{depth}")
+            start = os.path.join(tree, *[f"d{level}" for level in range(depth)])
+            os.makedirs(start)
+            open(os.path.join(tree, "package.json"), "w").close()
+            names = ["package.json", ".git", "pyproject.toml", "config/app.json"]
+
+            print(f"Depth {depth}, 4 names (package.json at the top, the rest missing):")
+            time_calls(
+                "  naive exists() walk, per name",
+                lambda: [naive_find_upwards(name, start) for name in names],
+                args.iterations,
+            )
+
+            def cold():
+                psu._upward_cache.clear()
+                psu.find_files_upwards(names, start=start)
+
+            time_calls("  find_files_upwards, cold", cold, args.iterations)
+            psu.find_files_upwards(names, start=start)
+            time_calls(
+                "  find_files_upwards, warm cache",
+                lambda: psu.find_files_upwards(names, start=start),
+                args.iterations,
+            )
+    finally:
+        shutil.rmtree(root)
+
+
+def bench_find(args):
+    """Compare os.walk against find_files on a tree with a gitignored node_modules"""
+    root = tempfile.mkdtemp(prefix="pyscript_util_bench_")
+    try:
+        with open(os.path.join(root, ".gitignore"), "w") as f:
+            f.write("node_modules/\n")
+        for package in range(args.packages):
+            package_dir = os.path.join(root, "node_modules", f"pkg{package}", "lib")
+            os.makedirs(package_dir)
+            for index in range(20):
+                open(os.path.join(package_dir, f"m{index}.js"), "w").close()
+        for module in range(50):
+            source_dir = os.path.join(root, "src", f"mod{module}")
+            os.makedirs(source_dir)
+            for index in range(10):
+                open(os.path.join(source_dir, f"f{index}.py"), "w").close()
+
+        print(f"{args.packages} packages in node_modules, 500 source files:")
+        time_calls(
+            "  os.walk + fnmatch, no pruning",
+            lambda: [name for _, _, files in os.walk(root) for name in files if name.endswith(".py")],
+            args.iterations,
+        )
+        time_calls("  find_files, serial", lambda: list(psu.find_files(root, "*.py")), args.iterations)
+        time_calls(
+            "  find_files, 4 workers",
+            lambda: list(psu.find_files(root, "*.py", max_workers=4)),
+            args.iterations,
+        )
+    finally:
+        shutil.rmtree(root)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="pyscript_util microbenchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark")
+
+    engines = subparsers.add_parser("engines", help="per-call overhead of execution engines")
+    engines.add_argument("-n", "--iterations", type=int, default=200)
+    engines.add_argument("--ballast-mb", type=int, default=0,
+                         help="allocate this much memory first to inflate fork cost")
+    engines.set_defaults(func=bench_engines)
+
+    session = subparsers.add_parser("session", help="persistent shell session vs os.system")
+    session.add_argument("-n", "--iterations", type=int, default=10000)
+    session.set_defaults(func=bench_session)
+
+    upward = subparsers.add_parser("upward", help="cold vs cached upward file searches")
+    upward.add_argument("-n", "--iterations", type=int, default=2000)
+    upward.add_argument("--depths", default="5,20,50", help="comma-separated directory depths")
+    upward.set_defaults(func=bench_upward)
+
+    find = subparsers.add_parser("find", help="os.walk vs find_files on a gitignored tree")
+    find.add_argument("-n", "--iterations", type=int, default=5)
+    find.add_argument("--packages", type=int, default=200, help="packages in node_modules")
+    find.set_defaults(func=bench_find)
+
+    args = parser.parse_args()
+    if not getattr(args, "func", None):
+        parser.print_help()
+        return 1
+    args.func(args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -78,6 +78,7 @@ def should_skip_item(item_name, item_path):
         # Development and build scripts
         'export_offline_installer.py',
         'publish_to_pip.py',
+        'benchmark.py',
         'release_package.py',
         'deploy_script.py',
         'dev_setup.py',
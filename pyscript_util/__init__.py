@@ -8,13 +8,63 @@ from .pyscript_util import (
     run_root_cmd,
     run_cmd_sure,
     run_root_cmd_sure,
+    run_cmd_ex,
+    run_root_cmd_ex,
+    run_cmd_sure_ex,
+    run_root_cmd_sure_ex,
+    CommandResult,
+    CommandStream,
+    stream_cmd,
+    set_command_metrics_file,
+    RetryPolicy,
+    set_default_retry_policy,
+    get_default_retry_policy,
+    run_cmds_parallel,
+    run_cmds_parallel_sure,
+    run_cmd_cached,
+    run_cmd_async,
+    run_root_cmd_async,
+    run_cmd_sure_async,
+    run_root_cmd_sure_async,
+    CommandFailedError,
+    ParallelCommandsFailedError,
+    CommandTimeoutError,
+    CommandCancelledError,
+    SystemEngine,
+    SpawnEngine,
+    ShellSession,
+    root_batch,
+    set_execution_engine,
+    get_execution_engine,
+    get_caller_script,
     chdir_to_cur_file,
     setup_script_environment,
     find_file_upwards,
+    working_dir,
+    find_files_upwards,
+    find_files,
+    DEFAULT_SKIP_NAMES,
+    enable_upward_search_index,
+    find_executable,
+    probe_version,
+    sourced_env,
+    ArtifactCache,
+    ArtifactError,
+    set_artifact_cache,
+    get_artifact_cache,
+    packages,
+    request_packages,
+    install_packages,
     setup_npm,
     get_available_functions,
     print_available_functions,
     stage,
+    TaskGraph,
+    enable_checkpoints,
+    clear_checkpoints,
+    enable_stage_profiling,
+    print_stage_profile,
+    write_stage_trace,
     add_usage_to_cursorrule,
 )
 
@@ -24,12 +74,62 @@ __all__ = [
     "run_root_cmd",
     "run_cmd_sure",
     "run_root_cmd_sure",
+    "run_cmd_ex",
+    "run_root_cmd_ex",
+    "run_cmd_sure_ex",
+    "run_root_cmd_sure_ex",
+    "CommandResult",
+    "CommandStream",
+    "stream_cmd",
+    "set_command_metrics_file",
+    "RetryPolicy",
+    "set_default_retry_policy",
+    "get_default_retry_policy",
+    "run_cmds_parallel",
+    "run_cmds_parallel_sure",
+    "run_cmd_cached",
+    "run_cmd_async",
+    "run_root_cmd_async",
+    "run_cmd_sure_async",
+    "run_root_cmd_sure_async",
+    "CommandFailedError",
+    "ParallelCommandsFailedError",
+    "CommandTimeoutError",
+    "CommandCancelledError",
+    "SystemEngine",
+    "SpawnEngine",
+    "ShellSession",
+    "root_batch",
+    "set_execution_engine",
+    "get_execution_engine",
+    "get_caller_script",
     "chdir_to_cur_file",
     "setup_script_environment",
     "find_file_upwards",
+    "working_dir",
+    "find_files_upwards",
+    "find_files",
+    "DEFAULT_SKIP_NAMES",
+    "enable_upward_search_index",
+    "find_executable",
+    "probe_version",
+    "sourced_env",
+    "ArtifactCache",
+    "ArtifactError",
+    "set_artifact_cache",
+    "get_artifact_cache",
+    "packages",
+    "request_packages",
+    "install_packages",
     "setup_npm",
     "get_available_functions",
     "print_available_functions",
     "stage",
+    "TaskGraph",
+    "enable_checkpoints",
+    "clear_checkpoints",
+    "enable_stage_profiling",
+    "print_stage_profile",
+    "write_stage_trace",
     "add_usage_to_cursorrule",
 ]
@@ -0,0 +1,136 @@
+"""
+Tests for ArtifactCache against a local stand-in HTTP server (no internet access)
+"""
+
+import functools
+import hashlib
+import http.server
+import json
+import os
+import tarfile
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+from pyscript_util import pyscript_util as psu
+
+INSTALLER_URL = "https://downloads.example.invalid/tool/v1.0.0/install.sh"
+INSTALLER = b"#!/bin/sh\necho installing tool v1.0.0\n"
+INSTALLER_SHA256 = hashlib.sha256(INSTALLER).hexdigest()
+
+
+class _CountingHandler(http.server.SimpleHTTPRequestHandler):
+    """Static file handler that counts GET requests and logs nothing"""
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        super().do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def mirror(tmp_path):
+    """Serve tmp_path/mirror, laid out as <host>/<path>, on a local port"""
+    root = tmp_path / "mirror"
+    target = root / "downloads.example.invalid" / "tool" / "v1.0.0" / "install.sh"
+    target.parent.mkdir(parents=True)
+    target.write_bytes(INSTALLER)
+
+    handler = functools.partial(_CountingHandler, directory=str(root))
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server, f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def offline_cache(tmp_path, mirror_url, name="cache"):
+    """A cache that can only reach the local mirror"""
+    return psu.ArtifactCache(str(tmp_path / name), mirror=mirror_url, offline=True)
+
+
+def test_fetch_from_local_mirror_then_hit(tmp_path, mirror):
+    server, url = mirror
+    cache = offline_cache(tmp_path, url)
+    path = cache.fetch(INSTALLER_URL, sha256=INSTALLER_SHA256)
+    with open(path, "rb") as f:
+        assert f.read() == INSTALLER
+    assert cache.fetch(INSTALLER_URL, sha256=INSTALLER_SHA256) == path
+    assert cache.fetch(INSTALLER_URL) == path  # by URL, through the index
+    assert len(server.requests) == 1
+
+
+def test_seeded_cache_hits_without_any_source(tmp_path, mirror):
+    _, url = mirror
+    source = offline_cache(tmp_path, url, "source")
+    source.fetch(INSTALLER_URL, sha256=INSTALLER_SHA256)
+    bundle_dir = tmp_path / "bundle"
+    assert source.export_bundle(str(bundle_dir)) == 1
+    bundle_tar = tmp_path / "bundle.tar.gz"
+    with tarfile.open(bundle_tar, "w:gz") as archive:
+        archive.add(str(bundle_dir), arcname=".")
+
+    for bundle in (bundle_dir, bundle_tar):
+        cache = psu.ArtifactCache(str(tmp_path / f"seeded-{bundle.name}"), offline=True)
+        assert cache.seed(str(bundle)) == 1
+        with open(cache.fetch(INSTALLER_URL, sha256=INSTALLER_SHA256), "rb") as f:
+            assert f.read() == INSTALLER
+
+
+def test_digest_mismatch_is_rejected(tmp_path, mirror):
+    _, url = mirror
+    cache = offline_cache(tmp_path, url)
+    with pytest.raises(psu.ArtifactError, match="SHA-256 mismatch"):
+        cache.fetch(INSTALLER_URL, sha256="0" * 64)
+    assert cache.lookup(INSTALLER_URL) is None
+    assert cache.lookup(INSTALLER_URL, INSTALLER_SHA256) is None
+
+
+def test_corrupted_entry_is_downloaded_again(tmp_path, mirror):
+    server, url = mirror
+    cache = offline_cache(tmp_path, url)
+    path = cache.fetch(INSTALLER_URL, sha256=INSTALLER_SHA256)
+    with open(path, "wb") as f:
+        f.write(b"#!/bin/sh\nrm -rf /\n")
+
+    path = cache.fetch(INSTALLER_URL, sha256=INSTALLER_SHA256)
+    with open(path, "rb") as f:
+        assert f.read() == INSTALLER
+    assert len(server.requests) == 2
+
+
+@pytest.mark.parametrize("url, digest", [
+    ("https://example.invalid/../../outside.sh", INSTALLER_SHA256),
+    ("https://example.invalid/a/./b.sh", INSTALLER_SHA256),
+    ("file:///etc/passwd", INSTALLER_SHA256),
+    (INSTALLER_URL, "../../../outside"),
+    (INSTALLER_URL, "0" * 63),
+])
+def test_seed_rejects_unsafe_manifest_entries(tmp_path, url, digest):
+    bundle = tmp_path / "bundle"
+    bundle.mkdir()
+    (bundle / "manifest.json").write_text(json.dumps({url: digest}))
+    cache = psu.ArtifactCache(str(tmp_path / "cache"), offline=True)
+    with pytest.raises(psu.ArtifactError):
+        cache.seed(str(bundle))
+    assert not (tmp_path / "outside").exists()
+    assert not (tmp_path / "outside.sh").exists()
+
+
+def test_pinned_installer_digests():
+    """Download every pinned installer and recompute its digest (needs internet)"""
+    for url, expected in psu._INSTALLER_SHA256.items():
+        try:
+            with urllib.request.urlopen(url, timeout=15) as response:
+                data = response.read()
+        except (urllib.error.URLError, OSError) as e:
+            pytest.skip(f"cannot download {url}: {e}")
+        assert hashlib.sha256(data).hexdigest() == expected, url
@@ -0,0 +1,90 @@
+"""
+Tests for RetryPolicy against a local flaky-command stub
+"""
+
+import os
+import shlex
+
+import pytest
+
+from pyscript_util import pyscript_util as psu
+
+
+def flaky_command(tmp_path, failures, exit_code, message=""):
+    """
+    Get a command that fails 'failures' times (printing message to stderr and
+    exiting with exit_code), then succeeds; attempts are counted in a file
+    """
+    counter = tmp_path / "attempts"
+    script = tmp_path / "flaky.sh"
+    script.write_text(
+        "#!/bin/sh\n"
+        f"n=$(cat {shlex.quote(str(counter))} 2>/dev/null || echo 0)\n"
+        "n=$((n + 1))\n"
+        f"echo \"$n\" > {shlex.quote(str(counter))}\n"
+        f"if [ \"$n\" -le {failures} ]; then\n"
+        f"    echo {shlex.quote(message)} >&2\n"
+        f"    exit {exit_code}\n"
+        "fi\n"
+        "echo ok\n"
+    )
+    os.chmod(script, 0o755)
+    return f"sh {shlex.quote(str(script))}"
+
+
+def attempts(tmp_path):
+    return int((tmp_path / "attempts").read_text())
+
+
+def test_retries_listed_exit_code_until_success(tmp_path):
+    policy = psu.RetryPolicy(max_attempts=3, backoff=0, retry_on_exit_codes={7})
+    result = psu.run_cmd_ex(flaky_command(tmp_path, 2, 7), retry=policy)
+    assert result.exit_code == 0
+    assert attempts(tmp_path) == 3
+    assert [r.exit_code for r in result.attempts] == [7, 7, 0]
+    assert all(r.wall_time is not None for r in result.attempts)
+
+
+def test_unlisted_exit_code_is_not_retried(tmp_path):
+    policy = psu.RetryPolicy(max_attempts=3, backoff=0, retry_on_exit_codes={7})
+    with pytest.raises(psu.CommandFailedError):
+        psu.run_cmd_sure(flaky_command(tmp_path, 2, 1), retry=policy)
+    assert attempts(tmp_path) == 1
+
+
+def test_retries_matching_output(tmp_path):
+    policy = psu.RetryPolicy(max_attempts=3, backoff=0, retry_on_output=[r"Could not resolve"])
+    command = flaky_command(tmp_path, 1, 1, "curl: (6) Could not resolve host: example.com")
+    assert psu.run_cmd_sure(command, retry=policy) == 0
+    assert attempts(tmp_path) == 2
+
+
+def test_gives_up_after_max_attempts(tmp_path):
+    policy = psu.RetryPolicy(max_attempts=2, backoff=0)
+    with pytest.raises(psu.CommandFailedError) as error:
+        psu.run_cmd_sure(flaky_command(tmp_path, 5, 3), retry=policy)
+    assert error.value.exit_code == 3
+    assert attempts(tmp_path) == 2
+
+
+@pytest.mark.parametrize("exit_code, output", [
+    (7, ""),
+    (1, "curl: (6) Could not resolve host: deb.nodesource.com"),
+    (100, "Temporary failure resolving 'archive.ubuntu.com'"),
+    (100, "E: Could not get lock /var/lib/dpkg/lock-frontend"),
+    (1, "npm ERR! code ECONNRESET"),
+])
+def test_install_policy_retries_transient_failures(exit_code, output):
+    result = psu.CommandResult("step", exit_code, output_tail=output)
+    assert psu._INSTALL_RETRY_POLICY.should_retry(result)
+
+
+@pytest.mark.parametrize("exit_code, output", [
+    (100, "E: Unable to locate package nodejsx"),
+    (1, "No package nodejsx available."),
+    (243, "npm ERR! code EACCES"),
+    (1, "Error: No available formula with the name \"node@99\"."),
+])
+def test_install_policy_fails_fast_on_permanent_failures(exit_code, output):
+    result = psu.CommandResult("step", exit_code, output_tail=output)
+    assert not psu._INSTALL_RETRY_POLICY.should_retry(result)